@@ -1,18 +1,39 @@
 import os
+import sys
 import re
+import json
 import asyncio
+import hashlib
+import functools
+import random
+import argparse
+import sqlite3
 import time
+import diskcache
+import tiktoken
+import httpx
 import nest_asyncio
 import openai
 from openai import AsyncOpenAI
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 
 # --- SETUP & COMPATIBILITY ---
-# Apply patch for Jupyter/Async loops
-nest_asyncio.apply()
+# Jupyter already runs an event loop; only patch it there since the patch slows every await
+IN_JUPYTER = "ipykernel" in sys.modules
+if IN_JUPYTER:
+    nest_asyncio.apply()
 
 # Initialize Clients
-client = AsyncOpenAI()
+# One pooled HTTP/2 connection set shared by every OpenAI call, so concurrent rounds reuse TLS sessions
+http_client = httpx.AsyncClient(
+    http2=True,
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+    # Judge and generator calls don't stream, so no bytes arrive until generation ends; keep the SDK's 600s read budget
+    timeout=httpx.Timeout(60.0, connect=5.0, read=600.0),
+)
+# Retries are handled by with_retries alone, not stacked on the SDK's own
+client = AsyncOpenAI(http_client=http_client, max_retries=0)
 
 # Get Gemini Key
 gemini_api_key = os.environ.get("GEMINI_API_KEY")
@@ -22,9 +43,49 @@ if not gemini_api_key:
 else:
     genai.configure(api_key=gemini_api_key)
 
+# Per-provider cap on in-flight requests
+OPENAI_SEM = asyncio.Semaphore(int(os.environ.get("OPENAI_MAX_ASYNC", 8)))
+GEMINI_SEM = asyncio.Semaphore(int(os.environ.get("GEMINI_MAX_ASYNC", 4)))
+
+# OpenAI account limits for proactive throttling
+OPENAI_RPM = int(os.environ.get("OPENAI_RPM", 500))
+OPENAI_TPM = int(os.environ.get("OPENAI_TPM", 30000))
+
+# Transient failures are retried; auth and malformed requests are not
+MAX_ATTEMPTS = 3
+RETRIABLE_ERRORS = (
+    openai.RateLimitError, openai.APIConnectionError, openai.APITimeoutError, openai.InternalServerError,
+    google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.InternalServerError,
+)
+# Same statuses the OpenAI SDK's own retry policy covers (besides 429 and 5xx, which the classes above catch)
+RETRIABLE_STATUS_CODES = (408, 409)
+NON_RETRIABLE_ERRORS = (openai.AuthenticationError, openai.BadRequestError)
+
 # The Judge and Generator use a stable, smart model
 INFRA_MODEL = "gpt-4-turbo" 
 
+# Judge prompts are capped so long reasonings can't overflow the context window
+MAX_JUDGE_INPUT_TOKENS = 6000
+TRUNCATION_MARKER = "…[truncated]"
+
+# Max rounds buffered between pipeline stages
+PIPELINE_DEPTH = 2
+
+# Seconds both fighters get to answer a problem
+SOLVER_TIMEOUT = float(os.environ.get("ARENA_SOLVER_TIMEOUT", 300))
+
+# Deterministic (temperature 0) judge calls are cached on disk, keyed on the exact judge prompt: only a round
+# re-judged with the same answers (e.g. a checkpointed round after --resume) is served from it
+CACHE_DIR = "./.arena_cache"
+CACHE_TTL = int(os.environ.get("ARENA_CACHE_TTL", 7 * 24 * 3600))
+
+# Every judged round is written here so an interrupted tournament can be resumed
+DB_PATH = "arena.db"
+
+# With --batch-judge, tournaments of at least this many rounds are judged via the OpenAI Batch API
+BATCH_JUDGE_MIN_ROUNDS = 10
+BATCH_POLL_INTERVAL = 30
+
 # --- UI COLORS ---
 class bcolors:
     HEADER = '\033[95m'
@@ -64,6 +125,17 @@ If one is clearly better, conclude with: "The winner of the match is: [Name]"
 If they are equal in accuracy and reasoning, conclude with: "The winner of the match is: Tie"
 """
 
+JUDGE_INPUT_TEMPLATE = (
+    "Problem: {problem}\n"
+    "Generator's Proposed Answer: {gen_ans}\n"
+    "--- {name_1} ---\n"
+    "Answer: {a1}\n"
+    "Reasoning: {r1}\n"
+    "--- {name_2} ---\n"
+    "Answer: {a2}\n"
+    "Reasoning: {r2}\n"
+)
+
 GENERATOR_INSTRUCTIONS = """Create a difficult math problem (Algebra, Logic, or Probability). 
 Ensure the problem has a unique, verifiable solution.
 Format:
@@ -72,27 +144,169 @@ Final Answer: [Ans]"""
 
 # --- CLASSES ---
 
+class RateLimiter:
+    """Token bucket over requests and tokens per minute; waits only as long as the deficit requires."""
+
+    def __init__(self, rpm: int, tpm: int):
+        self.rpm = rpm
+        self.tpm = tpm
+        self.available_requests = float(rpm)
+        self.available_tokens = float(tpm)
+        self.last_refill = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_refill
+        self.available_requests = min(self.rpm, self.available_requests + elapsed * self.rpm / 60)
+        self.available_tokens = min(self.tpm, self.available_tokens + elapsed * self.tpm / 60)
+        self.last_refill = now
+
+    async def acquire(self, estimated_tokens: int):
+        estimated_tokens = min(estimated_tokens, self.tpm)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= estimated_tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= estimated_tokens
+                    return
+                request_wait = (1 - self.available_requests) * 60 / self.rpm
+                token_wait = (estimated_tokens - self.available_tokens) * 60 / self.tpm
+                await asyncio.sleep(max(request_wait, token_wait))
+
+openai_limiter = RateLimiter(OPENAI_RPM, OPENAI_TPM)
+
+class LLMCache:
+    def __init__(self, directory: str = CACHE_DIR, ttl: int = CACHE_TTL):
+        self._store = diskcache.Cache(directory)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(model: str, instructions: str, input_text: str, temperature: float) -> str:
+        payload = {"model": model, "instructions": instructions, "input": input_text, "temperature": temperature}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        value = self._store.get(key)
+        if value is None: self.misses += 1
+        else: self.hits += 1
+        return value
+
+    def set(self, key: str, value: str):
+        self._store.set(key, value, expire=self.ttl)
+
+    def close(self):
+        self._store.close()
+
+def is_retriable(e: Exception) -> bool:
+    if isinstance(e, RETRIABLE_ERRORS):
+        return True
+    return isinstance(e, openai.APIStatusError) and (e.status_code >= 500 or e.status_code in RETRIABLE_STATUS_CODES)
+
+def backoff_delay(attempt: int) -> float:
+    return min(60, 2 ** attempt + random.random())
+
+def with_retries(func):
+    """Retry transient API failures with exponential backoff; any other failure becomes an 'Error' string at once."""
+    @functools.wraps(func)
+    async def wrapper(self, input_text: str) -> str:
+        for attempt in range(1, MAX_ATTEMPTS + 1):
+            try:
+                return await func(self, input_text)
+            except NON_RETRIABLE_ERRORS as e:
+                print(f"{bcolors.FAIL}{self.name}: {type(e).__name__} is not retriable.{bcolors.ENDC}")
+                return f"Error running agent {self.name}: {e}"
+            except Exception as e:
+                if not is_retriable(e):
+                    return f"Error running agent {self.name}: {e}"
+                if attempt == MAX_ATTEMPTS:
+                    return f"Error running agent {self.name} after {attempt} attempts: {e}"
+                delay = backoff_delay(attempt)
+                print(f"{bcolors.WARNING}{self.name}: {type(e).__name__}, retrying in {delay:.1f}s...{bcolors.ENDC}")
+                await asyncio.sleep(delay)
+    return wrapper
+
 class Agent:
-    def __init__(self, name: str, model: str, instructions: str):
+    def __init__(self, name: str, model: str, instructions: str, temperature: float = 0.7, cache: LLMCache = None,
+                 stream: bool = False, color: str = None):
         self.name = name
         self.model = model
-        self.instructions = instructions
+        self._instructions = instructions
+        self.temperature = temperature
+        # Streamed responses are echoed live only when a color is given
+        self.stream = stream
+        self.color = color
+        # Only deterministic calls are cache-legal
+        self.cache = cache if temperature == 0 else None
+        # Instructions are fixed per agent and always sent as the system preamble, never mixed into the user turn:
+        # Gemini gets them once via system_instruction, and OpenAI sees a byte-identical first message on
+        # every call, which is what its automatic prompt cache keys on.
+        self._system_messages = [{"role": "system", "content": instructions}]
+        self._gemini_model = genai.GenerativeModel(model, system_instruction=instructions) if 'gemini' in model else None
+
+    @property
+    def instructions(self) -> str:
+        # Read-only: changing it would desync the prebuilt preambles (and the prompt caches) from the agent
+        return self._instructions
 
     async def run(self, input_text: str) -> str:
-        try:
-            if self.model.startswith('gpt-') or self.model.startswith('o1-'):
-                messages = [{"role": "system", "content": self.instructions}, {"role": "user", "content": input_text}]
-                response = await client.chat.completions.create(model=self.model, messages=messages, temperature=0.7)
-                return response.choices[0].message.content.strip()
-            elif 'gemini' in self.model:
-                model_instance = genai.GenerativeModel(self.model)
-                full_prompt = f"{self.instructions}\n\nUser Input:\n{input_text}"
-                response = await model_instance.generate_content_async(full_prompt)
-                return response.text.strip()
-            else:
-                return f"Error: Model '{self.model}' is not supported."
-        except Exception as e:
-            return f"Error running agent {self.name}: {e}"
+        if self.cache is None:
+            return await self._call(input_text)
+        key = LLMCache.make_key(self.model, self.instructions, input_text, self.temperature)
+        cached = self.cache.get(key)
+        if cached is not None:
+            return cached
+        output = await self._call(input_text)
+        if not output.startswith("Error"):
+            self.cache.set(key, output)
+        return output
+
+    def chat_body(self, input_text: str) -> dict:
+        messages = [*self._system_messages, {"role": "user", "content": input_text}]
+        return {"model": self.model, "messages": messages, "temperature": self.temperature}
+
+    @with_retries
+    async def _call(self, input_text: str) -> str:
+        if self.model.startswith('gpt-') or self.model.startswith('o1-'):
+            await openai_limiter.acquire(estimated_tokens=(len(self.instructions) + len(input_text)) // 4 + 400)
+            async with OPENAI_SEM:
+                if not self.stream:
+                    response = await client.chat.completions.create(**self.chat_body(input_text))
+                    return response.choices[0].message.content.strip()
+                response = await client.chat.completions.create(**self.chat_body(input_text), stream=True)
+                parts = []
+                async for chunk in response:
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        self._collect(parts, chunk.choices[0].delta.content)
+            return self._finish(parts)
+        elif 'gemini' in self.model:
+            async with GEMINI_SEM:
+                if not self.stream:
+                    response = await self._gemini_model.generate_content_async(input_text)
+                    return response.text.strip()
+                response = await self._gemini_model.generate_content_async(input_text, stream=True)
+                parts = []
+                async for chunk in response:
+                    # Prompt-feedback/blocked chunks have no candidates and finish-reason chunks no parts;
+                    # .parts and .text raise on those respectively
+                    if chunk.candidates and chunk.parts:
+                        self._collect(parts, chunk.text)
+            return self._finish(parts)
+        else:
+            return f"Error: Model '{self.model}' is not supported."
+
+    def _collect(self, parts: list, text: str):
+        parts.append(text)
+        if self.color:
+            print(f"{self.color}{text}{bcolors.ENDC}", end="", flush=True)
+
+    def _finish(self, parts: list) -> str:
+        if self.color:
+            print()
+        return "".join(parts).strip()
 
 class Runner:
     @staticmethod
@@ -102,10 +316,14 @@ class Runner:
 
 # --- PARSING LOGIC ---
 
+_PROB_RE = re.compile(r"Problem Statement:(.*?)(Final Answer:|$)", re.DOTALL | re.IGNORECASE)
+_ANS_RE = re.compile(r"Final Answer:(.*)", re.DOTALL | re.IGNORECASE)
+_REASON_RE = re.compile(r"Reasoning:(.*?)(Final Answer:|$)", re.DOTALL | re.IGNORECASE)
+
 def parse_math_problem_output(text: str) -> dict:
     try:
-        problem_statement = re.search(r"Problem Statement:(.*?)(Final Answer:|$)", text, re.DOTALL | re.IGNORECASE).group(1).strip()
-        final_answer_text = re.search(r"Final Answer:(.*)", text, re.DOTALL | re.IGNORECASE).group(1).strip()
+        problem_statement = _PROB_RE.search(text).group(1).strip()
+        final_answer_text = _ANS_RE.search(text).group(1).strip()
         return {"problem_statement": problem_statement, "correct_final_answer": final_answer_text}
     except Exception:
         return {"problem_statement": text, "correct_final_answer": "Unknown"}
@@ -113,103 +331,416 @@ def parse_math_problem_output(text: str) -> dict:
 def parse_solver_output(text: str) -> dict:
     reasoning, final_answer = "No reasoning provided.", text
     try:
-        reasoning_match = re.search(r"Reasoning:(.*?)(Final Answer:|$)", text, re.DOTALL | re.IGNORECASE)
-        answer_match = re.search(r"Final Answer:(.*)", text, re.DOTALL | re.IGNORECASE)
+        reasoning_match = _REASON_RE.search(text)
+        answer_match = _ANS_RE.search(text)
         if reasoning_match: reasoning = reasoning_match.group(1).strip()
         if answer_match: final_answer = answer_match.group(1).strip()
     except Exception:
         pass
     return {"reasoning": reasoning, "final_answer": final_answer}
 
-def extract_winner(verdict_text, name1, name2):
-    verdict_lower = verdict_text.lower()
-    if "tie" in verdict_lower and "winner" in verdict_lower: return "Tie"
-    if f"winner of the match is: {name1.lower()}" in verdict_lower: return name1
-    if f"winner of the match is: {name2.lower()}" in verdict_lower: return name2
-    if "is: tie" in verdict_lower: return "Tie"
-    return None
+def make_winner_extractor(name1, name2):
+    # Longest names first so a name that prefixes the other can't shadow it
+    labels = {"tie": "Tie", name1.lower(): name1, name2.lower(): name2}
+    alternatives = "|".join(re.escape(label) for label in sorted(labels, key=len, reverse=True))
+    winner_re = re.compile(rf"winner of the match is:\s*({alternatives})(?!\w)", re.IGNORECASE)
+
+    def extract_winner(verdict_text):
+        # The judge concludes with the verdict line, so earlier restatements of the format don't count
+        matches = [*winner_re.finditer(verdict_text)]
+        return labels[matches[-1].group(1).lower()] if matches else None
+    return extract_winner
+
+# --- PERSISTENCE ---
+
+def open_arena_db(path: str = DB_PATH) -> sqlite3.Connection:
+    # Autocommit + WAL keeps each per-round write short so it barely blocks the event loop
+    conn = sqlite3.connect(path, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("""CREATE TABLE IF NOT EXISTS tournaments(
+        id INTEGER PRIMARY KEY, model_1 TEXT, model_2 TEXT, rounds INTEGER, finished INTEGER DEFAULT 0,
+        judge_batch_id TEXT)""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS rounds(
+        tournament_id INTEGER, round INTEGER, problem TEXT, ans1 TEXT, reas1 TEXT, ans2 TEXT, reas2 TEXT,
+        verdict TEXT, winner TEXT, gen_ans TEXT, PRIMARY KEY (tournament_id, round))""")
+    # Databases created before these columns existed
+    _ensure_column(conn, "tournaments", "judge_batch_id", "TEXT")
+    _ensure_column(conn, "rounds", "gen_ans", "TEXT")
+    return conn
+
+def _ensure_column(conn: sqlite3.Connection, table: str, column: str, decl: str):
+    if column not in {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}:
+        conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+def find_unfinished_tournament(conn: sqlite3.Connection, model_1: str, model_2: str):
+    return conn.execute("""
+        SELECT t.id, t.rounds, COALESCE(MAX(CASE WHEN r.verdict IS NOT NULL THEN r.round END), 0), t.judge_batch_id
+        FROM tournaments t
+        LEFT JOIN rounds r ON r.tournament_id = t.id
+        WHERE t.model_1 = ? AND t.model_2 = ? AND t.finished = 0
+        GROUP BY t.id ORDER BY t.id DESC LIMIT 1""", (model_1, model_2)).fetchone()
+
+def start_tournament(conn: sqlite3.Connection, model_1: str, model_2: str, rounds: int) -> int:
+    return conn.execute("INSERT INTO tournaments(model_1, model_2, rounds) VALUES (?, ?, ?)", (model_1, model_2, rounds)).lastrowid
+
+def load_scoreboard(conn: sqlite3.Connection, tournament_id: int, scoreboard: dict):
+    for winner, count in conn.execute("SELECT winner, COUNT(*) FROM rounds WHERE tournament_id = ? GROUP BY winner", (tournament_id,)):
+        if winner in scoreboard: scoreboard[winner] += count
+
+def save_round(conn: sqlite3.Connection, tournament_id: int, item: dict):
+    out1, out2 = item["out1"], item["out2"]
+    conn.execute("""INSERT OR REPLACE INTO rounds(tournament_id, round, problem, gen_ans, ans1, reas1, ans2, reas2, verdict, winner)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", (
+        tournament_id, item["round"], item["problem"]["problem_statement"], item["problem"]["correct_final_answer"],
+        out1["final_answer"], out1["reasoning"], out2["final_answer"], out2["reasoning"],
+        item.get("verdict"), item.get("winner")))
+
+def load_checkpointed_rounds(conn: sqlite3.Connection, tournament_id: int, start_round: int) -> list:
+    """Rounds that were solved but never judged, rebuilt into pipeline items."""
+    rows = conn.execute("""SELECT round, problem, gen_ans, ans1, reas1, ans2, reas2 FROM rounds
+        WHERE tournament_id = ? AND round >= ? AND verdict IS NULL ORDER BY round""", (tournament_id, start_round))
+    return [{
+        "round": rnd,
+        "problem": {"problem_statement": problem, "correct_final_answer": gen_ans or "Unknown"},
+        "out1": {"final_answer": ans1, "reasoning": reas1},
+        "out2": {"final_answer": ans2, "reasoning": reas2},
+    } for rnd, problem, gen_ans, ans1, reas1, ans2, reas2 in rows]
+
+def save_judge_batch_id(conn: sqlite3.Connection, tournament_id: int, batch_id: str):
+    conn.execute("UPDATE tournaments SET judge_batch_id = ? WHERE id = ?", (batch_id, tournament_id))
+
+def finish_tournament(conn: sqlite3.Connection, tournament_id: int):
+    conn.execute("UPDATE tournaments SET finished = 1 WHERE id = ?", (tournament_id,))
+
+# --- PIPELINE STAGES ---
+
+async def generate_stage(generator: Agent, start_round: int, rounds: int, problems: asyncio.Queue):
+    for i in range(start_round, rounds + 1):
+        prob_res = await Runner.run(generator, "Generate a hard math problem.")
+        prob_data = parse_math_problem_output(prob_res["final_output"])
+        await problems.put({"round": i, "problem": prob_data})
+    await problems.put(None)
+
+async def solve_one(slot: str, fighter: Agent, statement: str):
+    start = time.monotonic()
+    res = await Runner.run(fighter, statement)
+    return slot, fighter, time.monotonic() - start, parse_solver_output(res["final_output"])
+
+async def solve_stage(fighter_1: Agent, fighter_2: Agent, problems: asyncio.Queue, solved: asyncio.Queue, preloaded=()):
+    # Rounds solved by an interrupted run go straight to the judge
+    for item in preloaded:
+        await solved.put(item)
+    while (item := await problems.get()) is not None:
+        statement = item["problem"]["problem_statement"]
+        tasks = [
+            asyncio.create_task(solve_one("out1", fighter_1, statement)),
+            asyncio.create_task(solve_one("out2", fighter_2, statement)),
+        ]
+        try:
+            for next_done in asyncio.as_completed(tasks, timeout=SOLVER_TIMEOUT):
+                slot, fighter, elapsed, output = await next_done
+                item[slot] = output
+                print(f"Round {item['round']}: {fighter.name} answered in {elapsed:.1f}s")
+        except asyncio.TimeoutError:
+            for task in tasks: task.cancel()
+        # A solver that misses the deadline forfeits the round instead of stalling the tournament
+        for slot, fighter in (("out1", fighter_1), ("out2", fighter_2)):
+            if slot not in item:
+                print(f"{bcolors.FAIL}Round {item['round']}: {fighter.name} timed out after {SOLVER_TIMEOUT}s.{bcolors.ENDC}")
+                item[slot] = {"reasoning": "No reasoning provided.", "final_answer": f"No answer (timed out after {SOLVER_TIMEOUT}s, forfeit)."}
+        await solved.put(item)
+    await solved.put(None)
+
+@functools.lru_cache(maxsize=None)
+def _judge_encoding():
+    # Loaded on first use: tiktoken may download the encoding, which must not happen at import time
+    return tiktoken.encoding_for_model(INFRA_MODEL)
+
+def _encode(text: str) -> list:
+    # Model output may contain strings like <|endoftext|>; count them as plain text rather than raising
+    return _judge_encoding().encode(text, disallowed_special=())
+
+def build_judge_input(item: dict, name_1: str, name_2: str) -> str:
+    prob_data, out1, out2 = item["problem"], item["out1"], item["out2"]
+    fields = {
+        "problem": prob_data["problem_statement"], "gen_ans": prob_data["correct_final_answer"],
+        "name_1": name_1, "a1": out1["final_answer"], "r1": out1["reasoning"],
+        "name_2": name_2, "a2": out2["final_answer"], "r2": out2["reasoning"],
+    }
+
+    judge_input = JUDGE_INPUT_TEMPLATE.format_map(fields)
+    overflow = len(_encode(judge_input)) - MAX_JUDGE_INPUT_TOKENS
+    if overflow <= 0:
+        return judge_input
+
+    # Cut both reasonings by the same fraction so neither fighter is favoured
+    tokens_1, tokens_2 = _encode(fields["r1"]), _encode(fields["r2"])
+    total = len(tokens_1) + len(tokens_2)
+    if total == 0:
+        return judge_input
+    marker_budget = 2 * (len(_encode(TRUNCATION_MARKER)) + 1)
+    keep_ratio = max(0, total - overflow - marker_budget) / total
+    def shorten(tokens):
+        keep = int(len(tokens) * keep_ratio)
+        return _judge_encoding().decode(tokens[:keep]) + TRUNCATION_MARKER if keep < len(tokens) else _judge_encoding().decode(tokens)
+    return JUDGE_INPUT_TEMPLATE.format_map({**fields, "r1": shorten(tokens_1), "r2": shorten(tokens_2)})
+
+async def judge_stage(judge: Agent, name_1: str, name_2: str, solved: asyncio.Queue, judged: asyncio.Queue):
+    extract_winner = make_winner_extractor(name_1, name_2)
+    while (item := await solved.get()) is not None:
+        judge_res = await Runner.run(judge, build_judge_input(item, name_1, name_2))
+        item["verdict"] = judge_res["final_output"]
+        item["winner"] = extract_winner(item["verdict"])
+        await judged.put(item)
+    await judged.put(None)
+
+async def call_with_retries(label: str, func, *args, **kwargs):
+    """Await func with the same bounded backoff as with_retries, re-raising once attempts run out."""
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await func(*args, **kwargs)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS or not is_retriable(e): raise
+            delay = backoff_delay(attempt)
+            print(f"{bcolors.WARNING}{label}: {type(e).__name__}, retrying in {delay:.1f}s...{bcolors.ENDC}")
+            await asyncio.sleep(delay)
+
+async def run_judge_batch(judge: Agent, judge_inputs: dict, batch_id: str = None, on_submit=None) -> dict:
+    try:
+        if batch_id:
+            batch = await call_with_retries("Judge batch lookup", client.batches.retrieve, batch_id)
+            print(f"Resuming judge batch {batch.id} ({batch.status}), waiting for results...")
+        else:
+            lines = [
+                json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": judge.chat_body(text)})
+                for custom_id, text in judge_inputs.items()
+            ]
+            batch_file = await call_with_retries("Judge batch upload", client.files.create,
+                                                 file=("judge_batch.jsonl", "\n".join(lines).encode("utf-8")), purpose="batch")
+            batch = await call_with_retries("Judge batch creation", client.batches.create,
+                                            input_file_id=batch_file.id, endpoint="/v1/chat/completions", completion_window="24h")
+            if on_submit: on_submit(batch.id)
+            print(f"Judge batch {batch.id} submitted ({len(lines)} requests), waiting for results...")
+
+        progress = None
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            await asyncio.sleep(BATCH_POLL_INTERVAL)
+            try:
+                batch = await client.batches.retrieve(batch.id)
+            except Exception as e:
+                # The batch keeps running server-side, so a transient poll failure is not worth losing it over
+                if not is_retriable(e): raise
+                print(f"{bcolors.WARNING}Judge batch {batch.id}: {type(e).__name__} while polling, will retry.{bcolors.ENDC}")
+                continue
+            counts = batch.request_counts
+            if counts and (batch.status, counts.completed, counts.failed) != progress:
+                progress = (batch.status, counts.completed, counts.failed)
+                print(f"Judge batch {batch.id}: {batch.status} ({counts.completed}/{counts.total} done, {counts.failed} failed)")
+
+        if batch.status != "completed" or not batch.output_file_id:
+            return {custom_id: f"Error: judge batch {batch.id} ended with status '{batch.status}'." for custom_id in judge_inputs}
+
+        output = await call_with_retries("Judge batch download", client.files.content, batch.output_file_id)
+    except openai.OpenAIError as e:
+        print(f"{bcolors.FAIL}Judge batch failed: {type(e).__name__}: {e}{bcolors.ENDC}")
+        return {custom_id: f"Error: judge batch failed: {e}" for custom_id in judge_inputs}
+
+    verdicts = {}
+    for line in output.text.splitlines():
+        if not line.strip(): continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        try:
+            verdicts[record["custom_id"]] = record["response"]["body"]["choices"][0]["message"]["content"].strip()
+        except (KeyError, IndexError, TypeError):
+            verdicts[record.get("custom_id")] = f"Error: batch request failed: {record.get('error')}"
+    return verdicts
+
+async def batch_judge_stage(judge: Agent, name_1: str, name_2: str, solved: asyncio.Queue, judged: asyncio.Queue,
+                            checkpoint=None, on_submit=None, batch_id: str = None):
+    extract_winner = make_winner_extractor(name_1, name_2)
+    items = []
+    while (item := await solved.get()) is not None:
+        # The batch can take up to 24h; checkpointed rounds (and the batch id from on_submit) let a resumed run
+        # pick the same batch back up, or re-judge the saved answers, instead of solving everything again
+        if checkpoint: checkpoint(item)
+        items.append(item)
+
+    judge_inputs = {f"round-{item['round']}": build_judge_input(item, name_1, name_2) for item in items}
+    verdicts = await run_judge_batch(judge, judge_inputs, batch_id=batch_id, on_submit=on_submit)
+    for item in items:
+        item["verdict"] = verdicts.get(f"round-{item['round']}", "Error: no verdict returned by the judge batch.")
+        item["winner"] = extract_winner(item["verdict"])
+        await judged.put(item)
+    await judged.put(None)
+
+async def get_or_fail(queue: asyncio.Queue, stages: list):
+    """Wait for the next item on queue, re-raising a stage's exception instead of waiting forever."""
+    get_task = asyncio.create_task(queue.get())
+    try:
+        while True:
+            running = {stage for stage in stages if not stage.done()}
+            await asyncio.wait({get_task, *running}, return_when=asyncio.FIRST_COMPLETED)
+            if get_task.done():
+                return get_task.result()
+            for stage in stages:
+                if stage.done() and not stage.cancelled() and stage.exception():
+                    raise stage.exception()
+    finally:
+        get_task.cancel()
+
+def report_round(item: dict, rounds: int, name_1: str, name_2: str, scoreboard: dict):
+    winner = item["winner"]
+    print(f"\n{bcolors.HEADER}===== ROUND {item['round']} of {rounds} ====={bcolors.ENDC}")
+    print(f"Problem: {bcolors.BOLD}{item['problem']['problem_statement']}{bcolors.ENDC}")
+
+    print(f"\n{bcolors.OKCYAN}{name_1}:{bcolors.ENDC} {item['out1']['final_answer']}")
+    print(f"{bcolors.OKGREEN}{name_2}:{bcolors.ENDC} {item['out2']['final_answer']}")
+
+    print(f"\n{bcolors.WARNING}Judge's Verdict:\n{item['verdict']}{bcolors.ENDC}")
+
+    if winner == "Tie":
+        scoreboard["Tie"] += 1
+        print(f"🤝 Result: {bcolors.BOLD}IT'S A TIE!{bcolors.ENDC}")
+    elif winner:
+        scoreboard[winner] += 1
+        print(f"🏆 Round Winner: {bcolors.BOLD}{winner}{bcolors.ENDC}")
+    else:
+        print(f"{bcolors.FAIL}Error: Could not determine winner.{bcolors.ENDC}")
+
+    print(f"Score: {name_1}: {scoreboard[name_1]} | {name_2}: {scoreboard[name_2]} | Ties: {scoreboard['Tie']}")
 
 # --- MAIN LOOP ---
 
-async def main():
+def prompt_config(args: argparse.Namespace):
+    r_input = input(f"How many rounds? (Default: {args.rounds}): ")
+    args.rounds = int(r_input) if r_input.strip() else args.rounds
+
+    print(f"\n{bcolors.OKCYAN}Configure Fighter 1:{bcolors.ENDC}")
+    m1_input = input(f"Enter Model ID (default: {args.model1}): ")
+    args.model1 = m1_input.strip() if m1_input.strip() else args.model1
+
+    print(f"\n{bcolors.OKGREEN}Configure Fighter 2:{bcolors.ENDC}")
+    m2_input = input(f"Enter Model ID (default: {args.model2}): ")
+    args.model2 = m2_input.strip() if m2_input.strip() else args.model2
+
+async def main(args: argparse.Namespace):
     print(f"{bcolors.HEADER}--- ⚔️ WELCOME TO THE DYNAMIC AI ARENA ⚔️ ---{bcolors.ENDC}")
-    
-    try:
-        r_input = input("How many rounds? (Default: 1): ")
-        rounds = int(r_input) if r_input.strip() else 1
-        
-        print(f"\n{bcolors.OKCYAN}Configure Fighter 1:{bcolors.ENDC}")
-        m1_input = input("Enter Model ID (default: gpt-5.1): ")
-        model_1 = m1_input.strip() if m1_input.strip() else "gpt-5.1"
-        name_1 = get_clean_name(model_1)
-
-        print(f"\n{bcolors.OKGREEN}Configure Fighter 2:{bcolors.ENDC}")
-        m2_input = input("Enter Model ID (default: gemini-3-pro-preview): ")
-        model_2 = m2_input.strip() if m2_input.strip() else "gemini-3-pro-preview"
-        name_2 = get_clean_name(model_2)
-    except ValueError:
-        return
 
+    # stdin would block the notebook's running event loop, so Jupyter always uses the given arguments
+    interactive = args.interactive and not IN_JUPYTER
+    if interactive:
+        try:
+            prompt_config(args)
+        except ValueError:
+            return
+
+    rounds, model_1, model_2 = args.rounds, args.model1, args.model2
+    name_1, name_2 = get_clean_name(model_1), get_clean_name(model_2)
+
+    db = open_arena_db()
+    start_round = 1
+    checkpointed, batch_id = [], None
+    unfinished = find_unfinished_tournament(db, model_1, model_2)
+    resume = args.resume
+    if unfinished and interactive:
+        answer = input(f"Resume unfinished {name_1} vs {name_2} tournament ({unfinished[2]}/{unfinished[1]} rounds done)? [Y/n]: ")
+        resume = answer.strip().lower() in ("", "y", "yes")
+    if unfinished and resume:
+        tournament_id, rounds, start_round, batch_id = unfinished[0], unfinished[1], unfinished[2] + 1, unfinished[3]
+        checkpointed = load_checkpointed_rounds(db, tournament_id, start_round)
+        print(f"Resuming tournament {tournament_id} from round {start_round} of {rounds} "
+              f"({len(checkpointed)} solved round(s) awaiting a verdict).")
+    else:
+        tournament_id = start_tournament(db, model_1, model_2, rounds)
+
+    cache = LLMCache(args.cache_dir)
+    # The generator stays sampled and uncached so every tournament gets fresh problems
     Math_Problem_Generator = Agent("Generator", INFRA_MODEL, GENERATOR_INSTRUCTIONS)
     current_judge_instructions = JUDGE_TEMPLATE.format(name_1=name_1, name_2=name_2)
-    Judge_Agent = Agent("Judge", INFRA_MODEL, current_judge_instructions)
+    Judge_Agent = Agent("Judge", INFRA_MODEL, current_judge_instructions, temperature=0, cache=cache)
     
-    Fighter_1 = Agent(name_1, model_1, SOLVER_INSTRUCTIONS)
-    Fighter_2 = Agent(name_2, model_2, SOLVER_INSTRUCTIONS)
+    Fighter_1 = Agent(name_1, model_1, SOLVER_INSTRUCTIONS, stream=True)
+    Fighter_2 = Agent(name_2, model_2, SOLVER_INSTRUCTIONS, stream=True)
 
     scoreboard = {name_1: 0, name_2: 0, "Tie": 0}
+    load_scoreboard(db, tournament_id, scoreboard)
+
+    # Rounds are pipelined: round N+1 is generated while N is being solved, and N is judged while N+1 is solved.
+    problems = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    solved = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+    judged = asyncio.Queue(maxsize=PIPELINE_DEPTH)
+
+    # Judging is post-hoc, so large tournaments can trade latency for the Batch API's lower price
+    remaining = rounds - start_round + 1
+    # A batch submitted by the interrupted run covers every checkpointed round, so poll it rather than pay again
+    resume_batch_id = batch_id if checkpointed else None
+    if resume_batch_id or (args.batch_judge and remaining >= BATCH_JUDGE_MIN_ROUNDS):
+        judge_runner = functools.partial(
+            batch_judge_stage,
+            checkpoint=lambda item: save_round(db, tournament_id, item),
+            on_submit=lambda submitted_id: save_judge_batch_id(db, tournament_id, submitted_id),
+            batch_id=resume_batch_id,
+        )
+    else:
+        judge_runner = judge_stage
+
+    generate_from = checkpointed[-1]["round"] + 1 if checkpointed else start_round
+    print(f"\nRunning {remaining} round(s)...")
+    stages = [
+        asyncio.create_task(generate_stage(Math_Problem_Generator, generate_from, rounds, problems)),
+        asyncio.create_task(solve_stage(Fighter_1, Fighter_2, problems, solved, preloaded=checkpointed)),
+        asyncio.create_task(judge_runner(Judge_Agent, name_1, name_2, solved, judged)),
+    ]
 
-    for i in range(1, rounds + 1):
-        print(f"\n{bcolors.HEADER}===== ROUND {i} of {rounds} ====={bcolors.ENDC}")
-        print("Generating problem...")
-        prob_res = await Runner.run(Math_Problem_Generator, "Generate a hard math problem.")
-        prob_data = parse_math_problem_output(prob_res["final_output"])
-        print(f"Problem: {bcolors.BOLD}{prob_data['problem_statement']}{bcolors.ENDC}")
-
-        print("Solvers are thinking...")
-        task1 = Runner.run(Fighter_1, prob_data['problem_statement'])
-        task2 = Runner.run(Fighter_2, prob_data['problem_statement'])
-        res1, res2 = await asyncio.gather(task1, task2)
-
-        out1 = parse_solver_output(res1["final_output"])
-        out2 = parse_solver_output(res2["final_output"])
-
-        print(f"\n{bcolors.OKCYAN}{name_1}:{bcolors.ENDC} {out1['final_answer']}")
-        print(f"{bcolors.OKGREEN}{name_2}:{bcolors.ENDC} {out2['final_answer']}")
-
-        print("\nJudging...")
-        judge_input = f"""
-        Problem: {prob_data['problem_statement']}
-        Generator's Proposed Answer: {prob_data['correct_final_answer']}
-        --- {name_1} ---
-        Answer: {out1['final_answer']}
-        Reasoning: {out1['reasoning']}
-        --- {name_2} ---
-        Answer: {out2['final_answer']}
-        Reasoning: {out2['reasoning']}
-        """
-        judge_res = await Runner.run(Judge_Agent, judge_input)
-        verdict = judge_res["final_output"]
-        winner = extract_winner(verdict, name_1, name_2)
-
-        print(f"{bcolors.WARNING}Judge's Verdict:\n{verdict}{bcolors.ENDC}")
-
-        if winner == "Tie":
-            scoreboard["Tie"] += 1
-            print(f"🤝 Result: {bcolors.BOLD}IT'S A TIE!{bcolors.ENDC}")
-        elif winner:
-            scoreboard[winner] += 1
-            print(f"🏆 Round Winner: {bcolors.BOLD}{winner}{bcolors.ENDC}")
-        else:
-            print(f"{bcolors.FAIL}Error: Could not determine winner.{bcolors.ENDC}")
-
-        print(f"Score: {name_1}: {scoreboard[name_1]} | {name_2}: {scoreboard[name_2]} | Ties: {scoreboard['Tie']}")
-        if i < rounds: await asyncio.sleep(2)
+    try:
+        pending = {}
+        next_round = start_round
+        while next_round <= rounds:
+            item = await get_or_fail(judged, stages)
+            if item is None: break
+            pending[item["round"]] = item
+            while next_round in pending:
+                item = pending.pop(next_round)
+                report_round(item, rounds, name_1, name_2, scoreboard)
+                save_round(db, tournament_id, item)
+                next_round += 1
+
+        await asyncio.gather(*stages)
+        finish_tournament(db, tournament_id)
+    finally:
+        # If one stage failed the others would block on their queues forever
+        for stage in stages: stage.cancel()
+        await asyncio.gather(*stages, return_exceptions=True)
+        cache.close()
+        db.close()
 
     print(f"\n{bcolors.HEADER}=== FINAL RESULTS ==={bcolors.ENDC}")
     print(f"{name_1}: {scoreboard[name_1]}")
     print(f"{name_2}: {scoreboard[name_2]}")
     print(f"Ties: {scoreboard['Tie']}")
+    print(f"Judge cache: {cache.hits} hits / {cache.misses} misses")
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Pit two LLMs against each other in judged math duels.")
+    parser.add_argument("--rounds", type=int, default=1, help="Number of rounds to play.")
+    parser.add_argument("--model1", default="gpt-5.1", help="Model ID for Fighter 1.")
+    parser.add_argument("--model2", default="gemini-3-pro-preview", help="Model ID for Fighter 2.")
+    parser.add_argument("--batch-judge", action="store_true",
+                        help=f"Judge via the OpenAI Batch API when running at least {BATCH_JUDGE_MIN_ROUNDS} rounds.")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="Directory for the judge verdict cache.")
+    parser.add_argument("--resume", action="store_true", help="Resume the last unfinished tournament between these models.")
+    parser.add_argument("--interactive", action="store_true", help="Prompt for the configuration on stdin (ignored in Jupyter).")
+    return parser.parse_args(argv)
+
+async def run_arena(args: argparse.Namespace):
+    try:
+        await main(args)
+    finally:
+        await http_client.aclose()
 
 if __name__ == "__main__":
-    asyncio.run(main())
\ No newline at end of file
+    # The kernel's own argv is not ours to parse
+    asyncio.run(run_arena(parse_args([] if IN_JUPYTER else None)))